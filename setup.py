@@ -16,7 +16,9 @@ setup(
         'squidpy>=1.2,<1.3',
         'plotly>=6.0,<6.1',
         'gseapy>=1.0,<1.1',
-        'kaleido>=0.2.1,<0.3'
+        'kaleido>=0.2.1,<0.3',
+        'numba>=0.57,<0.58',
+        'joblib>=1.2,<2'
        
     ],
     author='Mintian Cui',
@@ -9,6 +9,7 @@ from .stniche import (
     plot_structure_hex, #绘制niche结构
     highlight_niche_on_spatial, #在切片上绘制niche
     run_niche_differential_and_enrichment, #识别niche功能
-    plot_spatial_communication_sankey #识别niche信号通路
+    plot_spatial_communication_sankey, #识别niche信号通路
+    build_spot_index #建立spot坐标索引
 )
 
@@ -1,14 +1,17 @@
 import pandas as pd
 import numpy as np
 from scipy.stats import mannwhitneyu
+from scipy.spatial.distance import pdist
 from statsmodels.stats.multitest import multipletests
 import matplotlib.pyplot as plt
 import seaborn as sns
 from collections import defaultdict
+from functools import lru_cache
+from contextlib import contextmanager
 from tqdm import tqdm
 from collections import Counter
-from itertools import combinations
 from matplotlib.patches import RegularPolygon
+from matplotlib.collections import LineCollection, PatchCollection
 import scanpy as sc
 import os
 import re
@@ -16,6 +19,174 @@ import gseapy as gp
 import squidpy as sq
 import plotly.graph_objects as go
 import plotly.colors as pc
+from numba import njit
+from joblib import Parallel, delayed
+
+
+_HEX_OFFSETS = (
+    (-1, 0), (1, 0),
+    (0, -2), (0, 2),
+    (-1, -1), (1, -1),
+    (-1, 1), (1, 1)
+)
+
+# spot (row, col) pairs are hashed as row * _COORD_HASH_BASE + col
+_COORD_HASH_BASE = 1 << 32
+
+# parenthesised suffixes such as "(hsa04110)" dropped from pathway terms
+_PAREN_RE = re.compile(r"\s*\(.*?\)")
+
+
+def _count_adj(rows, cols, clusters, n_clusters):
+    """Count hexagonal neighbor pairs between cluster codes on a dense grid."""
+    # pad by the largest offset so every shifted view stays inside the grid
+    grid = np.full((rows.max() + 3, cols.max() + 5), -1, dtype=np.int32)
+    grid[rows + 1, cols + 2] = clusters
+    height, width = grid.shape
+    center = grid[1:height - 1, 2:width - 2]
+
+    adj = np.zeros(n_clusters * n_clusters, dtype=np.int64)
+    for dr, dc in _HEX_OFFSETS:
+        neighbor = grid[1 + dr:height - 1 + dr, 2 + dc:width - 2 + dc]
+        mask = (center >= 0) & (neighbor >= 0)
+        adj += np.bincount(
+            center[mask].astype(np.int64) * n_clusters + neighbor[mask],
+            minlength=n_clusters * n_clusters
+        )
+    return adj.reshape(n_clusters, n_clusters)
+
+
+@njit(cache=True)
+def _extract_motifs(rows, cols, labels, allowed_pair_mask):
+    """
+    Enumerate 3rd-order motifs grown from allowed hexagonal 2nd-order pairs.
+
+    Spots sharing a (row, col) collapse onto the first occurrence and keep
+    the last label, like building a ``{(row, col): label}`` dict. Returns the
+    unique spots and the (n_motifs, 3) spot indices of each motif, in the
+    order the pairs and their neighbors are discovered.
+    """
+    offsets = _HEX_OFFSETS
+    n = rows.shape[0]
+    grid = np.full((rows.max() + 3, cols.max() + 5), -1, dtype=np.int32)
+    spot_rows = np.empty(n, dtype=np.int64)
+    spot_cols = np.empty(n, dtype=np.int64)
+    spot_labels = np.empty(n, dtype=np.int32)
+    n_spots = 0
+    for i in range(n):
+        r = rows[i] + 1
+        c = cols[i] + 2
+        if grid[r, c] < 0:
+            grid[r, c] = n_spots
+            spot_rows[n_spots] = r
+            spot_cols[n_spots] = c
+            n_spots += 1
+        spot_labels[grid[r, c]] = labels[i]
+
+    # every unordered pair is emitted once, from its earlier spot
+    pairs = np.empty((n_spots * len(offsets), 2), dtype=np.int32)
+    n_pairs = 0
+    for u in range(n_spots):
+        for dr, dc in offsets:
+            v = grid[spot_rows[u] + dr, spot_cols[u] + dc]
+            if v > u and allowed_pair_mask[spot_labels[u], spot_labels[v]]:
+                pairs[n_pairs, 0] = u
+                pairs[n_pairs, 1] = v
+                n_pairs += 1
+
+    # seen[w] == k marks spot w as already used to extend pair k, so a
+    # neighbor shared by both ends of a pair is emitted once
+    seen = np.full(n_spots, -1, dtype=np.int32)
+    motifs = np.empty((n_pairs * 2 * len(offsets), 3), dtype=np.int32)
+    n_motifs = 0
+    for k in range(n_pairs):
+        a = pairs[k, 0]
+        b = pairs[k, 1]
+        for end in (a, b):
+            for dr, dc in offsets:
+                w = grid[spot_rows[end] + dr, spot_cols[end] + dc]
+                if w < 0 or w == a or w == b or seen[w] == k:
+                    continue
+                seen[w] = k
+                motifs[n_motifs, 0] = a
+                motifs[n_motifs, 1] = b
+                motifs[n_motifs, 2] = w
+                n_motifs += 1
+
+    return (spot_rows[:n_spots] - 1, spot_cols[:n_spots] - 2,
+            spot_labels[:n_spots], motifs[:n_motifs])
+
+
+@njit(cache=True)
+def _expand_candidates(point_rows, point_cols, grid, seen):
+    """
+    Collect the distinct occupied hexagonal neighbors of a structure's points
+    on a padded label grid, skipping the points themselves.
+
+    `seen` must be all False on entry and is cleared again before returning.
+    """
+    offsets = _HEX_OFFSETS
+    n = point_rows.shape[0]
+    height, width = grid.shape
+    out_rows = np.empty(n * len(offsets), dtype=np.int64)
+    out_cols = np.empty(n * len(offsets), dtype=np.int64)
+    out_codes = np.empty(n * len(offsets), dtype=np.int32)
+
+    for i in range(n):
+        r = point_rows[i] + 1
+        c = point_cols[i] + 2
+        if 0 <= r < height and 0 <= c < width:
+            seen[r, c] = True
+
+    k = 0
+    for i in range(n):
+        for dr, dc in offsets:
+            r = point_rows[i] + 1 + dr
+            c = point_cols[i] + 2 + dc
+            if r < 0 or c < 0 or r >= height or c >= width:
+                continue
+            if grid[r, c] < 0 or seen[r, c]:
+                continue
+            seen[r, c] = True
+            out_rows[k] = r - 1
+            out_cols[k] = c - 2
+            out_codes[k] = grid[r, c]
+            k += 1
+
+    for i in range(n):
+        r = point_rows[i] + 1
+        c = point_cols[i] + 2
+        if 0 <= r < height and 0 <= c < width:
+            seen[r, c] = False
+    for j in range(k):
+        seen[out_rows[j] + 1, out_cols[j] + 2] = False
+
+    return out_rows[:k], out_cols[:k], out_codes[:k]
+
+
+def _mannwhitneyu_columns(x, y, alternative='two-sided'):
+    """
+    Column-wise Mann-Whitney U p-values for 2D arrays `x` and `y`.
+
+    SciPy picks the exact or asymptotic method once for the whole batch, so
+    tied and untied columns are tested separately to keep the per-column
+    choice a scalar `mannwhitneyu` call would make.
+    """
+    pvals = np.ones(x.shape[1])
+    if x.shape[1] == 0:
+        return pvals
+    if x.shape[0] > 8 and y.shape[0] > 8:
+        return mannwhitneyu(x, y, alternative=alternative, axis=0).pvalue
+
+    combined = np.sort(np.concatenate([x, y], axis=0), axis=0)
+    has_ties = (np.diff(combined, axis=0) == 0).any(axis=0)
+    for tied, method in ((True, 'asymptotic'), (False, 'exact')):
+        cols = has_ties == tied
+        if cols.any():
+            pvals[cols] = mannwhitneyu(
+                x[:, cols], y[:, cols], alternative=alternative, method=method, axis=0
+            ).pvalue
+    return pvals
 
 
 def compute_groupwise_adjacency_matrix(
@@ -84,58 +255,32 @@ def compute_groupwise_adjacency_matrix(
     - Each sample contributes one adjacency matrix.
     - Fold-enrichment is calculated only for the `focus_group`.
     """
-    spot_data = adata.obs[[row_key, col_key, sample_key, cluster_key]].copy()
+    spot_data = adata.obs[[row_key, col_key, sample_key]].copy()
+    cluster_codes, all_leiden_classes = pd.factorize(adata.obs[cluster_key].to_numpy(), sort=True)
+    spot_data['_cluster_code'] = cluster_codes.astype(np.int32)
+    all_leiden_classes = all_leiden_classes.tolist()
+    n_clusters = len(all_leiden_classes)
     sample_adj_counts = {}
 
-    for sample in spot_data[sample_key].unique():
-        sample_spots = spot_data[spot_data[sample_key] == sample]
-        spot_dict = {
-            (row, col): cl for row, col, cl in zip(
-                sample_spots[row_key], sample_spots[col_key], sample_spots[cluster_key]
-            )
-        }
-
-        adj_counts = {}
-        for (row, col), cl in spot_dict.items():
-            if cl not in adj_counts:
-                adj_counts[cl] = {}
-            neighbors = [
-                (row - 1, col), (row + 1, col),
-                (row, col - 2), (row, col + 2),
-                (row - 1, col - 1), (row + 1, col - 1),
-                (row - 1, col + 1), (row + 1, col + 1)
-            ]
-            for nb in neighbors:
-                if nb in spot_dict:
-                    nb_cl = spot_dict[nb]
-                    if nb_cl not in adj_counts[cl]:
-                        adj_counts[cl][nb_cl] = 0
-                    adj_counts[cl][nb_cl] += 1
+    for sample, sample_spots in spot_data.groupby(sample_key, sort=False, observed=True):
+        codes = sample_spots['_cluster_code'].to_numpy()
+        rows = sample_spots[row_key].to_numpy(dtype=np.int64)
+        cols = sample_spots[col_key].to_numpy(dtype=np.int64)
+        rows = rows - rows.min()
+        cols = cols - cols.min()
 
-        adj_df = pd.DataFrame.from_dict(adj_counts, orient='index').fillna(0).astype(float)
-        leiden_counts = sample_spots[cluster_key].value_counts()
-        for cl in adj_df.index:
-            if cl in leiden_counts:
-                adj_df.loc[cl] /= leiden_counts[cl]
+        adj = _count_adj(rows, cols, codes, n_clusters).astype(float)
+        spot_counts = np.bincount(codes, minlength=n_clusters)
+        present = spot_counts > 0
+        adj[present] /= spot_counts[present, None]
 
-        sample_adj_counts[sample] = adj_df
-
-
-    all_samples_adj = pd.concat(sample_adj_counts, names=["library_id", "leiden"])
-    all_leiden_classes = sorted(all_samples_adj.columns.union(all_samples_adj.index.levels[1]))
+        sample_adj_counts[sample] = adj
 
 
     group_adj_matrices = {}
     for group in groups:
-        samples = adata.obs[adata.obs[group_key] == group][sample_key].unique().tolist()
-        group_matrices = []
-        for s in samples:
-            try:
-                df = all_samples_adj.xs(s, level="library_id")
-                df = df.fillna(0).reindex(index=all_leiden_classes, columns=all_leiden_classes, fill_value=0)
-                group_matrices.append(df.values)
-            except KeyError:
-                continue
+        samples = adata.obs.loc[adata.obs[group_key] == group, sample_key].unique().tolist()
+        group_matrices = [sample_adj_counts[s] for s in samples if s in sample_adj_counts]
         if group_matrices:
             group_adj_matrices[group] = np.array(group_matrices)
 
@@ -155,28 +300,22 @@ def compute_groupwise_adjacency_matrix(
     data2 = group_adj_matrices[group2]
 
     # Mann-Whitney U test + FDR
-    p_values, comparisons, group1_means, group2_means = [], [], [], []
+    flat1 = data1.reshape(data1.shape[0], -1)
+    flat2 = data2.reshape(data2.shape[0], -1)
+    tested = flat1.any(axis=0) & flat2.any(axis=0)
 
-    for i, l1 in enumerate(all_leiden_classes):
-        for j, l2 in enumerate(all_leiden_classes):
-            v1 = data1[:, i, j]
-            v2 = data2[:, i, j]
+    p_values = np.ones(flat1.shape[1])
+    p_values[tested] = _mannwhitneyu_columns(flat1[:, tested], flat2[:, tested])
 
-            if np.any(v1) and np.any(v2):
-                stat, p = mannwhitneyu(v1, v2, alternative='two-sided')
-            else:
-                p = 1.0
-
-            p_values.append(p)
-            comparisons.append((l1, l2))
-            group1_means.append(np.mean(v1))
-            group2_means.append(np.mean(v2))
+    leiden1, leiden2 = np.meshgrid(all_leiden_classes, all_leiden_classes, indexing='ij')
+    group1_means = flat1.mean(axis=0)
+    group2_means = flat2.mean(axis=0)
 
     _, fdrs, _, _ = multipletests(p_values, method='fdr_bh')
 
     fdr_results = pd.DataFrame({
-        "Leiden1": [c[0] for c in comparisons],
-        "Leiden2": [c[1] for c in comparisons],
+        "Leiden1": leiden1.ravel(),
+        "Leiden2": leiden2.ravel(),
         f"{group1}_mean": group1_means,
         f"{group2}_mean": group2_means,
         "P_value": p_values,
@@ -255,26 +394,25 @@ def plot_adj_difference_heatmap(
 
 
     disease_mat = adj_df.loc[first_group]
-    healthy_mat = adj_df.loc[second_group]
-
- 
-    diff_mat = disease_mat - healthy_mat
+    healthy_mat = adj_df.loc[second_group].reindex(index=disease_mat.index, columns=disease_mat.columns)
 
+    row_labels = disease_mat.index.astype(int).to_numpy()
+    col_labels = disease_mat.columns.astype(int).to_numpy()
+    row_order = np.argsort(row_labels, kind='stable')
+    col_order = np.argsort(col_labels, kind='stable')
 
-    diff_mat.columns = diff_mat.columns.astype(int)
-    diff_mat = diff_mat.reindex(sorted(diff_mat.columns), axis=1)
-    diff_mat.index = diff_mat.index.astype(int)
-    diff_mat = diff_mat.sort_index(axis=0)
-
-
-    np.fill_diagonal(diff_mat.values, 0)
+    diff = disease_mat.to_numpy() - healthy_mat.to_numpy()
+    diff = diff[np.ix_(row_order, col_order)]
+    np.fill_diagonal(diff, 0)
 
 
     plt.figure(figsize=(8, 7))
     sns.heatmap(
-        diff_mat,
+        diff,
         cmap=cmap,
         linewidths=0.5,
+        xticklabels=col_labels[col_order],
+        yticklabels=row_labels[row_order],
         cbar_kws={'label': f'{first_group} - {second_group}'}
     )
     plt.xlabel('cell cluster')
@@ -293,78 +431,72 @@ def plot_adj_difference_heatmap(
         plt.close()
 
 
-def geometric_signature(structure):
-    coordinates = structure[['x', 'y']].values
-    center = np.mean(coordinates, axis=0)
-    vectors = coordinates - center
-    distances = np.linalg.norm(vectors[:, np.newaxis, :] - vectors[np.newaxis, :, :], axis=-1)
-
+def structure_arrays(nodes):
+    coordinates = np.asarray([node[0] for node in nodes], dtype=np.int32)
+    labels = [node[1] for node in nodes]
+    names = [node[0] for node in nodes]
+    return coordinates, labels, names
 
-    distance_matrix = pd.DataFrame(distances, index=structure['name'], columns=structure['name'])
 
+@lru_cache(maxsize=None)
+def _upper_triangle_pairs(n):
+    # matches the condensed ordering returned by pdist
+    return np.triu_indices(n, k=1)
 
-    distance_matrix.index.name = None
-    distance_matrix.columns.name = None
 
- 
-    distance_flat = distance_matrix.stack().reset_index()
-
-  
-    distance_flat.columns = ['From', 'To', 'Distance']
+def geometric_signature(coordinates, labels, names):
+    distances = pdist(coordinates.astype(float))
+    iu, ju = _upper_triangle_pairs(len(coordinates))
+    order = np.argsort(distances, kind='stable')
+    iu, ju = iu[order], ju[order]
 
-
-    distance_flat = distance_flat[distance_flat['From'] < distance_flat['To']]
-
-    
-    sorted_distances = distance_flat.sort_values(by='Distance').reset_index(drop=True)
-
-   
-    labels_dict = structure.set_index('name')['label'].to_dict()
-    sorted_label_combinations = [(labels_dict[f], labels_dict[t]) for f, t in zip(sorted_distances['From'], sorted_distances['To'])]
+    sorted_distances = {
+        'From': [names[i] for i in iu],
+        'To': [names[j] for j in ju],
+        'Distance': distances[order]
+    }
+    sorted_label_combinations = [(labels[i], labels[j]) for i, j in zip(iu, ju)]
 
     return sorted_distances, sorted_label_combinations
 
 
-def compare_structures(sig1, sig2, labels1, labels2, tolerance=1e-6):
-
-
-   
-    distances1 = np.round(sig1['Distance'].to_numpy(), decimals=6)
-    distances2 = np.round(sig2['Distance'].to_numpy(), decimals=6)
-    
-    
-    if len(distances1) != len(distances2):
-        return False
-
-
-    normalized_labels1 = [tuple(sorted(label)) for label in labels1]
-    normalized_labels2 = [tuple(sorted(label)) for label in labels2]
-    #print(normalized_labels1)
-    #print(normalized_labels2)        
-    
-
-    from collections import defaultdict
-    group1 = defaultdict(list)
-    group2 = defaultdict(list)
+def canonical_structure_key(sig, labels):
+    """
+    Hashable key under which two structures are equal exactly when they
+    share the same pairwise distances (rounded to 6 decimals) with the same
+    unordered label pair at each distance.
+    """
+    distances = np.round(sig['Distance'], decimals=6)
+    return tuple(sorted(
+        (d, tuple(sorted(label))) for d, label in zip(distances.tolist(), labels)
+    ))
 
-    for d, label in zip(distances1, normalized_labels1):
-        group1[d].append(label)
 
-    for d, label in zip(distances2, normalized_labels2):
-        group2[d].append(label)
-   
-    #print(group1)
-    #print(group2)    
+def _summarize_structure_groups(grouped_structures, all_samples, sample_total_spots):
+    """
+    Per-group occurrence summary over `all_samples`.
 
-    for d in sorted(group1.keys()):  
-        if d not in group2:
-            return False  
-        
+    Returns the summary DataFrame together with the (n_groups, n_samples)
+    ratio matrix backing its 'Ratios' column, so callers can run
+    vectorized statistics without re-stacking the lists.
+    """
+    sample_index = {s: i for i, s in enumerate(all_samples)}
+    counts = np.zeros((len(grouped_structures), len(all_samples)))
+    for g, items in enumerate(grouped_structures.values()):
+        for sample, _ in items:
+            counts[g, sample_index[sample]] += 1
 
-        if sorted(group1[d]) != sorted(group2[d]):
-            return False
+    totals = np.array([sample_total_spots[s] for s in all_samples], dtype=float)
+    ratios_all = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
 
-    return True
+    df_counts = pd.DataFrame({
+        "Group_ID": list(grouped_structures),
+        "Count_Sample": (counts > 0).sum(axis=1),
+        "Count_Mean": counts.mean(axis=1),
+        "Ratio_Mean": ratios_all.mean(axis=1),
+        "Ratios": ratios_all.tolist()
+    })
+    return df_counts, ratios_all
 
 
 def extract_and_group_3rd_structures_from_2nd_with_ratio(
@@ -378,7 +510,8 @@ def extract_and_group_3rd_structures_from_2nd_with_ratio(
     leiden_key='leiden_0.7',
     coverage_threshold = 0.8,    
     fc_threshold=4.0,
-    p_threshold=0.05
+    p_threshold=0.05,
+    verbose=False
 ):
     """
     Identify and group third-order niche structures from second-order interactions,
@@ -426,6 +559,9 @@ def extract_and_group_3rd_structures_from_2nd_with_ratio(
     p_threshold : float, default=0.05
         FDR-corrected p-value threshold for statistical significance.
 
+    verbose : bool, default=False
+        Whether to show progress bars while extracting and matching structures.
+
     Returns
     -------
     grouped_structures : dict
@@ -452,116 +588,73 @@ def extract_and_group_3rd_structures_from_2nd_with_ratio(
     filter_unique_significant_structures : For deduplicating structure groups by label signature.
     """
    
-    neighbors_offset = [
-        (-1, 0), (1, 0),
-        (0, -2), (0, 2),
-        (-1, -1), (1, -1),
-        (-1, 1), (1, 1)
-    ]
-
-    focus_sample_ids = adata.obs[adata.obs[group_key] == focus_group][sample_key].unique()
+    focus_sample_ids = adata.obs.loc[adata.obs[group_key] == focus_group, sample_key].unique()
     sample_wise_structures = {}
     total_sample_count = len(focus_sample_ids)
 
-    
+    leiden_codes, leiden_classes = pd.factorize(adata.obs[leiden_key].astype(str))
+    leiden_classes = leiden_classes.to_numpy()
+    n_leiden = len(leiden_classes)
+
+    pair_codes = pd.Index(leiden_classes).get_indexer(
+        fdr_filtered_2nd[['Leiden1', 'Leiden2']].astype(str).to_numpy().ravel()
+    ).reshape(-1, 2)
+    pair_codes = pair_codes[(pair_codes >= 0).all(axis=1)]
+    allowed_pair_mask = np.zeros((n_leiden, n_leiden), dtype=np.bool_)
+    allowed_pair_mask[pair_codes[:, 0], pair_codes[:, 1]] = True
+    allowed_pair_mask[pair_codes[:, 1], pair_codes[:, 0]] = True
+
+    spot_data = adata.obs[[row_key, col_key]].copy()
+    spot_data['_leiden_code'] = leiden_codes.astype(np.int32)
+    spots_by_sample = spot_data.groupby(adata.obs[sample_key], sort=False, observed=True)
     for sample in focus_sample_ids:
-        sample_spots = adata.obs[adata.obs[sample_key] == sample][[row_key, col_key, leiden_key]]
-        spot_dict = {(r, c): str(l) for r, c, l in zip(sample_spots[row_key], sample_spots[col_key], sample_spots[leiden_key])}
-
-        visited_2nd = set()
-        structures_2nd = {}
-        sid_2nd = 0
-        for (row, col), spot_leiden in spot_dict.items():
-            for dr, dc in neighbors_offset:
-                nr, nc = row + dr, col + dc
-                if (nr, nc) in spot_dict:
-                    pair = {spot_leiden, spot_dict[(nr, nc)]}
-                    if tuple(sorted(pair)) in set(tuple(sorted((str(a), str(b)))) for a, b in fdr_filtered_2nd[['Leiden1', 'Leiden2']].values):
-                        if frozenset([(row, col), (nr, nc)]) not in visited_2nd:
-                            structures_2nd[f'structure_{sid_2nd}'] = [((row, col), spot_leiden), ((nr, nc), spot_dict[(nr, nc)])]
-                            visited_2nd.add(frozenset([(row, col), (nr, nc)]))
-                            sid_2nd += 1
-
-        visited_3rd = set()
-        structures_3rd = {}
-        sid_3rd = 0
-        for _, pts in structures_2nd.items():
-            (p1, l1), (p2, l2) = pts
-            for pr, pc in [p1, p2]:
-                for dr, dc in neighbors_offset:
-                    nr, nc = pr + dr, pc + dc
-                    if (nr, nc) in spot_dict and (nr, nc) not in [p1, p2]:
-                        key = frozenset([(p1, p2), (nr, nc)])
-                        if key not in visited_3rd:
-                            structures_3rd[f'structure_{sid_3rd}'] = [(p1, l1), (p2, l2), ((nr, nc), spot_dict[(nr, nc)])]
-                            visited_3rd.add(key)
-                            sid_3rd += 1
+        sample_spots = spots_by_sample.get_group(sample)
+        codes = sample_spots['_leiden_code'].to_numpy()
+        rows = sample_spots[row_key].to_numpy(dtype=np.int64)
+        cols = sample_spots[col_key].to_numpy(dtype=np.int64)
+        row_min, col_min = rows.min(), cols.min()
+
+        spot_rows, spot_cols, spot_labels, motifs = _extract_motifs(
+            rows - row_min, cols - col_min, codes, allowed_pair_mask
+        )
+        spot_nodes = [
+            ((r, c), l) for r, c, l in zip(
+                (spot_rows + row_min).tolist(), (spot_cols + col_min).tolist(), leiden_classes[spot_labels].tolist()
+            )
+        ]
+        structures_3rd = {
+            f'structure_{sid}': [spot_nodes[a], spot_nodes[b], spot_nodes[w]]
+            for sid, (a, b, w) in enumerate(motifs.tolist())
+        }
 
         sample_wise_structures[sample] = {"3rd": structures_3rd}
 
-    structure_signatures = {}
-    for sample, data in tqdm(sample_wise_structures.items(), desc="📦 提取结构特征"):
-        for structure_name, nodes in data["3rd"].items():
-            df = pd.DataFrame(nodes, columns=["(x, y)", "label"])
-            df["name"] = df["(x, y)"]
-            df["x"] = df["(x, y)"].apply(lambda p: p[0])
-            df["y"] = df["(x, y)"].apply(lambda p: p[1])
-            df.drop(columns=["(x, y)"], inplace=True)
-            sig, labels = geometric_signature(df)
-            structure_signatures[(sample, structure_name)] = (sig, labels)
+    structure_signatures = {
+        (sample, structure_name): canonical_structure_key(*geometric_signature(*structure_arrays(nodes)))
+        for sample, data in tqdm(sample_wise_structures.items(), desc="📦 提取结构特征", disable=not verbose)
+        for structure_name, nodes in data["3rd"].items()
+    }
 
     grouped_structures = {}
-    for (sample, sid), (sig, labels) in tqdm(structure_signatures.items(), desc="🧩 匹配结构"):
-        matched = None
-        for gid, items in grouped_structures.items():
-            ref_sample, ref_sid = items[0]
-            ref_sig, ref_labels = structure_signatures[(ref_sample, ref_sid)]
-            if compare_structures(sig, ref_sig, labels, ref_labels):
-                matched = gid
-                break
-        if matched is not None:
-            grouped_structures[matched].append((sample, sid))
-        else:
-            new_gid = len(grouped_structures)
-            grouped_structures[new_gid] = [(sample, sid)]
+    canonical_map = {}
+    for (sample, sid), key in tqdm(
+        structure_signatures.items(), desc="🧩 匹配结构",
+        miniters=max(1, len(structure_signatures) // 100), disable=not verbose
+    ):
+        gid = canonical_map.setdefault(key, len(canonical_map))
+        grouped_structures.setdefault(gid, []).append((sample, sid))
 
     print("\n📊 正在统计结构出现频率并比较组间差异...")
-    sample_structure_data = []
     all_samples = list(focus_sample_ids)
-    sample_total_spots = {s: np.sum(adata.obs[sample_key] == s) for s in all_samples}
-    group_ratios = defaultdict(lambda: np.zeros(len(all_samples)))
-    sample_index = {s: i for i, s in enumerate(all_samples)}
-
-    for gid, items in grouped_structures.items():
-        for sample, _ in items:
-            idx = sample_index[sample]
-            group_ratios[gid][idx] += 1
-
-    for gid, ratios in group_ratios.items():
-        ratio_values = []
-        sample_count = 0
-        for sid in all_samples:
-            idx = sample_index[sid]
-            count = ratios[idx]
-            total = sample_total_spots[sid]
-            ratio = count / total if total > 0 else 0
-            ratio_values.append(ratio)
-            if count > 0:
-                sample_count += 1
-        mean_ratio = np.mean(ratio_values)
-        sample_structure_data.append([
-            gid, sample_count, np.mean(ratios), mean_ratio, ratio_values
-        ])
-
-    df_counts = pd.DataFrame(sample_structure_data, columns=[
-        "Group_ID", "Count_Sample", "Count_Mean", "Ratio_Mean", "Ratios"
-    ])
+    spot_counts = adata.obs[sample_key].value_counts()
+    sample_total_spots = {s: spot_counts.get(s, 0) for s in all_samples}
+    df_counts, ratios_all = _summarize_structure_groups(grouped_structures, all_samples, sample_total_spots)
     
-    df_counts["Count_Mean_Other"] = [
-        np.mean([df_counts.loc[j, "Count_Mean"] for j in range(len(df_counts)) if j != i]) 
-        if len(df_counts) > 1 else 1e-9
-        for i in range(len(df_counts))
-    ]
+    count_means = df_counts["Count_Mean"].to_numpy()
+    n_groups = len(count_means)
+    df_counts["Count_Mean_Other"] = (
+        (count_means.sum() - count_means) / (n_groups - 1) if n_groups > 1 else 1e-9
+    )
 
 
    # df_counts["Fold_Change"] = df_counts["Count_Mean"] / df_counts["Count_Mean_Other"].replace(0, np.nan)
@@ -569,17 +662,11 @@ def extract_and_group_3rd_structures_from_2nd_with_ratio(
 
     df_counts["Coverage"] = df_counts["Count_Sample"] / total_sample_count
     
-    p_values = []
-    for i, row in df_counts.iterrows():
-        current_ratios = row["Ratios"]
-        other_ratios = np.mean(
-            [r for j, r in enumerate(df_counts["Ratios"]) if j != i], axis=0
-        )
-        try:
-            p = mannwhitneyu(current_ratios, other_ratios, alternative="greater").pvalue
-        except ValueError:
-            p = 1
-        p_values.append(p)
+    other_ratios = (ratios_all.sum(axis=0) - ratios_all) / max(n_groups - 1, 1)
+    try:
+        p_values = _mannwhitneyu_columns(ratios_all.T, other_ratios.T, alternative="greater")
+    except ValueError:
+        p_values = np.ones(n_groups)
 
     df_counts["P_Value"] = p_values
     df_counts["Adjusted_P"] = multipletests(p_values, method="fdr_bh")[1]
@@ -641,36 +728,28 @@ def filter_unique_significant_structures(
     """
 
 
-    def get_structure_label_signature(group_id):
-        structures = grouped_structures.get(group_id, [])
+    sig_map = {}
+    for group_id, structures in grouped_structures.items():
         if not structures:
-            return None
+            continue
         sample, structure_id = structures[0]
         structure = sample_wise_structures.get(sample, {}).get("3rd", {}).get(structure_id, None)
-        if not structure:
-            return None
-        labels = [label for _, label in structure]
-        return tuple(sorted(Counter(labels).items()))
-
-
-    signature_to_best_idx = {}
-
-    for idx, row in df_counts.iterrows():
-        group_id = row["Group_ID"]
-        signature = get_structure_label_signature(group_id)
-        if signature is None:
-            continue
-        if (
-            signature not in signature_to_best_idx or
-            row["P_Value"] < df_counts.loc[signature_to_best_idx[signature], "P_Value"]
-        ):
-            signature_to_best_idx[signature] = idx
-
-
-    unique_indices = list(signature_to_best_idx.values())
-
+        if structure:
+            sig_map[group_id] = tuple(sorted(Counter(label for _, label in structure).items()))
+
+    df_unique_filtered = df_counts.assign(signature=df_counts["Group_ID"].map(sig_map))
+    df_unique_filtered = df_unique_filtered.dropna(subset=["signature"])
+    # signature groups numbered by first appearance, the order the best
+    # rows are handed to the final Adjusted_P sort
+    df_unique_filtered = (
+        df_unique_filtered
+        .assign(first_seen=df_unique_filtered.groupby("signature", sort=False).ngroup())
+        .sort_values(by="P_Value", kind="stable")
+        .drop_duplicates(subset="signature", keep="first")
+        .sort_values(by="first_seen")
+        .drop(columns=["signature", "first_seen"])
+    )
 
-    df_unique_filtered = df_counts.loc[unique_indices].copy()
     df_unique_filtered = df_unique_filtered.sort_values(by="Adjusted_P").reset_index(drop=True)
     df_unique_filtered = df_unique_filtered[df_unique_filtered["Adjusted_P"] <= adjusted_p_threshold]
 
@@ -692,42 +771,25 @@ def group_structures_by_geometry(structures_dict):
 
  
     for structure_name, nodes in structures_dict.items():
-        df = pd.DataFrame(nodes, columns=["(x, y)", "label"])
-        df["name"] = df["(x, y)"]
-        df["x"] = df["(x, y)"].apply(lambda p: p[0])
-        df["y"] = df["(x, y)"].apply(lambda p: p[1])
-        df.drop(columns=["(x, y)"], inplace=True)
-
- 
-        signature, labels = geometric_signature(df)
-
-      
-        structure_signatures[structure_name] = (signature, labels)
+        structure_signatures[structure_name] = canonical_structure_key(
+            *geometric_signature(*structure_arrays(nodes))
+        )
 
 
     label_based_groups = group_by_label_sets(structures_dict)
 
 
+    # structures with different label sets can never match, so each
+    # label set keeps its own canonical key -> group id map
+    label_set_groups = {}
     for label_set, structure_names in label_based_groups.items():
+        canonical_map = label_set_groups.setdefault(label_set, {})
         for struct_name in structure_names:
-            sig, labels = structure_signatures[struct_name]
-            matched_group = None
-
-            for group_key, group_items in grouped_structures.items():
-                ref_struct = group_items[0]
-                ref_sig, ref_labels = structure_signatures[ref_struct]
-
-                if compare_structures(sig, ref_sig, labels, ref_labels):
-                    matched_group = group_key
-                    break  
-
-
-            if matched_group is not None:
-                grouped_structures[matched_group].append(struct_name)
-            else:
-      
-                new_group_key = len(grouped_structures)
-                grouped_structures[new_group_key] = [struct_name]
+            key = structure_signatures[struct_name]
+            if key not in canonical_map:
+                canonical_map[key] = len(grouped_structures)
+                grouped_structures[canonical_map[key]] = []
+            grouped_structures[canonical_map[key]].append(struct_name)
 
     return grouped_structures
 
@@ -755,66 +817,33 @@ def analyze_structure_groups(grouped_structures, adata, group_key= None, focus_g
         A summary table of statistical results per structural group.
     """
 
-    """
-    focus_sample_ids = adata.obs[adata.obs[group_key] == focus_group][sample_key].unique()
+    focus_sample_ids = adata.obs.loc[adata.obs[group_key] == focus_group, sample_key].unique()
     #sample_wise_structures = {}
     #total_sample_count = len(focus_sample_ids)
     #all_samples = adata.obs[sample_key].unique()
     all_samples = list(focus_sample_ids)
     
-    sample_total_spots = {s: np.sum(adata.obs[sample_key] == s) for s in all_samples}
+    spot_counts = adata.obs[sample_key].value_counts()
+    sample_total_spots = {s: spot_counts.get(s, 0) for s in all_samples}
     total_samples = len(all_samples)    
     #sample_total_spots = {s: np.sum(adata.obs[sample_key] == s) for s in all_samples}
-    sample_index = {s: i for i, s in enumerate(all_samples)}
-
-
-    group_counts = defaultdict(lambda: np.zeros(total_samples))
-
-    for gid, items in grouped_structures.items():
-        for sample, _ in items:
-            idx = sample_index[sample]
-            group_counts[gid][idx] += 1
-
-
-    sample_structure_data = []
-    for gid, counts in group_counts.items():
-        ratios = []
-        sample_count = 0
-        for sid in all_samples:
-            idx = sample_index[sid]
-            total = sample_total_spots[sid]
-            ratio = counts[idx] / total if total > 0 else 0
-            ratios.append(ratio)
-            if counts[idx] > 0:
-                sample_count += 1
-        mean_ratio = np.mean(ratios)
-        mean_count = np.mean(counts)
-        sample_structure_data.append([gid, sample_count, mean_count, mean_ratio, ratios])
-
-    df_counts = pd.DataFrame(sample_structure_data, columns=[
-        "Group_ID", "Count_Sample", "Count_Mean", "Ratio_Mean", "Ratios"
-    ])
+    df_counts, ratios_all = _summarize_structure_groups(grouped_structures, all_samples, sample_total_spots)
 
     # 添加 Count_Mean_Other、Fold_Change、Coverage
-    df_counts["Count_Mean_Other"] = [
-        np.mean([df_counts.loc[j, "Count_Mean"] for j in range(len(df_counts)) if j != i]) if len(df_counts) > 1 else 1e-9
-        for i in range(len(df_counts))
-    ]
+    count_means = df_counts["Count_Mean"].to_numpy()
+    n_groups = len(count_means)
+    df_counts["Count_Mean_Other"] = (
+        (count_means.sum() - count_means) / (n_groups - 1) if n_groups > 1 else 1e-9
+    )
     df_counts["Fold_Change"] = df_counts["Count_Mean"] / df_counts["Count_Mean_Other"].replace(0, np.nan).fillna(1e-9)
     df_counts["Coverage"] = df_counts["Count_Sample"] / total_samples
 
   
-    p_values = []
-    for i, row in df_counts.iterrows():
-        current_ratios = row["Ratios"]
-        other_ratios = np.mean(
-            [df_counts.loc[j, "Ratios"] for j in range(len(df_counts)) if j != i], axis=0
-        )
-        try:
-            p = mannwhitneyu(current_ratios, other_ratios, alternative="greater").pvalue
-        except ValueError:
-            p = 1.0
-        p_values.append(p)
+    other_ratios = (ratios_all.sum(axis=0) - ratios_all) / max(n_groups - 1, 1)
+    try:
+        p_values = _mannwhitneyu_columns(ratios_all.T, other_ratios.T, alternative="greater")
+    except ValueError:
+        p_values = np.ones(n_groups)
 
     df_counts["P_Value"] = p_values
     df_counts["Adjusted_P"] = multipletests(p_values, method="fdr_bh")[1]
@@ -828,8 +857,63 @@ def analyze_structure_groups(grouped_structures, adata, group_key= None, focus_g
 
     return df_counts.sort_values(by="Adjusted_P")
 
+def build_spot_dicts(adata, sample_key=None, row_key=None, col_key=None, leiden_key=None):
+    """
+    Map each sample to its ``{(row, col): leiden}`` spot dictionary in a
+    single groupby pass over `adata.obs`.
+    """
+    spots = adata.obs[[row_key, col_key, leiden_key]]
+    return {
+        sample: dict(zip(
+            zip(group[row_key].to_numpy().tolist(), group[col_key].to_numpy().tolist()),
+            group[leiden_key].astype(str).to_numpy().tolist()
+        ))
+        for sample, group in spots.groupby(adata.obs[sample_key], sort=False, observed=True)
+    }
+
+
+def build_spot_index(adata, sample_key='sample_id', row_key='array_row', col_key='array_col'):
+    """
+    Map every ``(sample, row, col)`` triple in `adata.obs` to the list of
+    obs names at that position, so niche nodes can be located with a dict
+    lookup instead of a scan. Duplicate spots keep all their names.
+    """
+    obs = adata.obs
+    spot_index = defaultdict(list)
+    for key, name in zip(
+        zip(obs[sample_key].to_numpy().tolist(),
+            obs[row_key].to_numpy().tolist(),
+            obs[col_key].to_numpy().tolist()),
+        obs.index.to_numpy().tolist()
+    ):
+        spot_index[key].append(name)
+    return dict(spot_index)
+
+
+def _spot_table(spot_dict):
+    """
+    Turn a ``{(row, col): leiden}`` dict into a padded grid of leiden codes
+    (-1 = no spot), the code -> leiden vocabulary and the (row, col) origin
+    the grid coordinates are relative to.
+    """
+    coords = np.array(list(spot_dict), dtype=np.int64).reshape(-1, 2)
+    codes, vocab = pd.factorize(np.array(list(spot_dict.values()), dtype=object))
+    # shift to the sample's minimum so negative or offset frames stay compact
+    origin = coords.min(axis=0)
+    coords = coords - origin
+    # pad by the largest offset so neighbors of edge spots stay inside the grid
+    grid = np.full((coords[:, 0].max() + 3, coords[:, 1].max() + 5), -1, dtype=np.int32)
+    grid[coords[:, 0] + 1, coords[:, 1] + 2] = codes
+    return grid, np.asarray(vocab, dtype=object), origin
+
+
+def build_spot_tables(spot_dicts):
+    """Build the per-sample `_spot_table` lookups for `expand_structure`."""
+    return {sample: _spot_table(spot_dict) for sample, spot_dict in spot_dicts.items()}
+
+
 def expand_structure(structure_dict, adata, sample_key=None, row_key=None,
-                     col_key=None, leiden_key =None):
+                     col_key=None, leiden_key =None, spot_dicts=None, spot_tables=None):
     """
     Expand the given structures to a higher level by adding one new node 
     on top of the current structure.
@@ -840,6 +924,12 @@ def expand_structure(structure_dict, adata, sample_key=None, row_key=None,
         and values are lists of nodes.
     - adata: AnnData  
         Annotated data object containing spatial coordinates and category information for each sample.
+    - spot_dicts: dict, optional  
+        Per-sample ``{(row, col): leiden}`` mappings from `build_spot_dicts`.
+        Built from `adata` when not given.
+    - spot_tables: dict, optional  
+        Per-sample coordinate lookups from `build_spot_tables`. Takes
+        precedence over `spot_dicts`; pass it to reuse the tables across calls.
 
     Returns:
     - expanded_structures: dict  
@@ -850,44 +940,41 @@ def expand_structure(structure_dict, adata, sample_key=None, row_key=None,
         print("❌ 结构字典为空，无法扩展！")
         return {}
 
-        
-    neighbors_offset = [
-        (-1, 0), (1, 0),  
-        (0, -2), (0, 2),  
-        (-1, -1), (1, -1),  
-        (-1, 1), (1, 1)  
-    ]
-    
-    expanded_structures = {}
-    visited_expanded = set()
-    structure_id = 0
-
-    for (sample, structure), points in structure_dict.items():
 
-        existing_points = {p[0] for p in points} 
-        existing_leidens = {p[1] for p in points}  
-        current_size = len(points) 
-
-
-        spot_dict = {  # 该样本的 (row, col) -> leiden 映射
-            (row, col): str(leiden)
-            for row, col, leiden in zip(
-                adata.obs.loc[adata.obs[sample_key] == sample, row_key],
-                adata.obs.loc[adata.obs[sample_key] == sample, col_key],
-                adata.obs.loc[adata.obs[sample_key] == sample, leiden_key]
+    if spot_tables is None:
+        if spot_dicts is None:
+            spot_dicts = build_spot_dicts(
+                adata, sample_key=sample_key, row_key=row_key,
+                col_key=col_key, leiden_key=leiden_key
             )
-        }
+        spot_tables = build_spot_tables(spot_dicts)
 
+    expanded_structures = {}
+    visited_expanded = defaultdict(set)  # sample -> frozensets of emitted spot sets
+    seen_masks = {}  # per-sample scratch masks for _expand_candidates
+    structure_id = 0
 
-        potential_new_nodes = set()
-        for pr, pc in existing_points:
-            for dr, dc in neighbors_offset:
-                nr, nc = pr + dr, pc + dc
-
+    for (sample, structure), points in structure_dict.items():
 
-                if (nr, nc) in spot_dict and (nr, nc) not in existing_points:
-                    leiden_new = spot_dict[(nr, nc)]
-                    potential_new_nodes.add(((nr, nc), leiden_new))
+        if sample not in spot_tables:
+            continue
+        grid, vocab, origin = spot_tables[sample]  # 该样本的 leiden 编码网格及其原点
+        if sample not in seen_masks:
+            seen_masks[sample] = np.zeros(grid.shape, dtype=np.bool_)
+        seen = seen_masks[sample]
+        visited = visited_expanded[sample]
+        existing_points = frozenset(p[0] for p in points)
+
+
+        coords = np.array([p[0] for p in points], dtype=np.int64).reshape(-1, 2) - origin
+        new_rows, new_cols, new_codes = _expand_candidates(coords[:, 0], coords[:, 1], grid, seen)
+        new_rows += origin[0]
+        new_cols += origin[1]
+
+        potential_new_nodes = [
+            ((r, c), leiden)
+            for r, c, leiden in zip(new_rows.tolist(), new_cols.tolist(), vocab[new_codes].tolist())
+        ]
 
 
         if not potential_new_nodes:
@@ -895,26 +982,49 @@ def expand_structure(structure_dict, adata, sample_key=None, row_key=None,
 
 
         for new_node in potential_new_nodes:
+            # different parents can grow into the same spot set; keep the first
+            signature = existing_points | {new_node[0]}
+            if signature in visited:
+                continue
+            visited.add(signature)
+
             new_structure_key = (sample, f"structure_{structure_id}")
 
 
             expanded_structures[new_structure_key] = points + [new_node]
-
-
-            visited_expanded.add((sample, tuple(sorted(existing_points | {new_node[0]}))))
             structure_id += 1
 
     return expanded_structures
 
+def _max_label_set_support(structures_dict, samples):
+    """
+    Largest number of `samples` sharing one label multiset. Structures in a
+    geometry group share their labels, so this bounds every group's sample count.
+    """
+    support = defaultdict(set)
+    for (sample, _), nodes in structures_dict.items():
+        if sample in samples:
+            support[tuple(sorted(str(node[1]) for node in nodes))].add(sample)
+    return max((len(s) for s in support.values()), default=0)
+
+
 def iterative_structure_analysis(initial_structures, adata, reference_row, coverage_threshold=None, 
                                  sample_key=None, row_key=None, col_key=None, 
                                  leiden_key=None,focus_group= None, group_key= None,
-                                 fc_threshold= None,p_threshold= None):
+                                 fc_threshold= None,p_threshold= None, spot_tables=None):
 
     extracted_structures = initial_structures
     last_valid_structures = initial_structures  
     iteration = 0
 
+    if spot_tables is None:
+        spot_tables = build_spot_tables(build_spot_dicts(
+            adata, sample_key=sample_key, row_key=row_key,
+            col_key=col_key, leiden_key=leiden_key
+        ))
+
+    focus_samples = set(adata.obs.loc[adata.obs[group_key] == focus_group, sample_key].unique())
+
     while True:
         iteration += 1
         print(f"开始第 {iteration} 轮结构扩展...")
@@ -923,13 +1033,24 @@ def iterative_structure_analysis(initial_structures, adata, reference_row, cover
         new_structures = expand_structure(
             extracted_structures, adata, 
             sample_key=sample_key, row_key=row_key,
-            col_key=col_key, leiden_key=leiden_key
+            col_key=col_key, leiden_key=leiden_key,
+            spot_tables=spot_tables
         )
         if not new_structures:
             print("❌ 无法扩展更多结构。终止迭代。")
             break
 
 
+        # no group can reach the coverage threshold, so skip grouping and
+        # testing; same comparison as the Coverage filter in analyze_structure_groups
+        if focus_samples and (
+            _max_label_set_support(new_structures, focus_samples) / len(focus_samples)
+            < coverage_threshold
+        ):
+            print("所有候选结构的样本覆盖率上限均低于阈值，提前终止迭代，返回上一次有效结构。")
+            break
+
+
         grouped = group_structures_by_geometry(new_structures)
         df_results = analyze_structure_groups(
             grouped, adata,
@@ -970,6 +1091,15 @@ def iterative_structure_analysis(initial_structures, adata, reference_row, cover
     print(f"✅ 迭代完成，共 {iteration} 轮，返回上一次有效结构集。")
     return last_valid_structures
 
+def _run_group_analysis(group_id, structure_details, adata, row, **kwargs):
+    """Run `iterative_structure_analysis` for one group, returning None on failure."""
+    try:
+        return iterative_structure_analysis(structure_details, adata, row, **kwargs)
+    except Exception as e:
+        print(f"❌ Group {group_id} 出错: {e}")
+        return None
+
+
 def run_iterative_analysis_over_df(
     df_filtered_new,
     grouped_structures,
@@ -983,7 +1113,8 @@ def run_iterative_analysis_over_df(
     focus_group=None,
     group_key='class1',
     fc_threshold=4,
-    p_threshold=0.05
+    p_threshold=0.05,
+    n_jobs=1
 ):
     """
     Run iterative niche analysis for each structure group in the filtered DataFrame.
@@ -1039,6 +1170,11 @@ def run_iterative_analysis_over_df(
     p_threshold : float, default=0.05
         Adjusted p-value threshold for statistical significance.
 
+    n_jobs : int, default=1
+        Number of worker processes used to analyze structure groups in parallel
+        (joblib semantics, -1 uses all cores). Groups are independent, so the
+        result does not depend on this setting.
+
     Returns
     -------
     result_dict : dict
@@ -1056,6 +1192,25 @@ def run_iterative_analysis_over_df(
     """
 
     result_dict = {}
+    jobs = []
+
+    # every group expands over the same spots, so build the lookups once
+    spot_tables = build_spot_tables(build_spot_dicts(
+        adata, sample_key=sample_key, row_key=row_key,
+        col_key=col_key, leiden_key=leiden_key
+    ))
+
+    flat_third = {
+        (sample, name): nodes
+        for sample, structures in sample_wise_structures.items()
+        for name, nodes in structures.get("3rd", {}).items()
+    }
+
+    analysis_kwargs = dict(
+        coverage_threshold=coverage_threshold, sample_key=sample_key, row_key=row_key,
+        col_key=col_key, leiden_key=leiden_key, focus_group=focus_group, group_key=group_key,
+        fc_threshold=fc_threshold, p_threshold=p_threshold, spot_tables=spot_tables
+    )
 
     for idx, row in df_filtered_new.iterrows():
         group_id = row["Group_ID"]
@@ -1064,28 +1219,35 @@ def run_iterative_analysis_over_df(
             print(f"⚠️ Group {group_id} 不在 grouped_structures 中，跳过")
             continue
 
-        structure_details = {}
-        for sample, structure in grouped_structures[group_id]:
-            if sample in sample_wise_structures:
-                structures_3rd = sample_wise_structures[sample].get("3rd", {})
-                if structure in structures_3rd:
-                    structure_details[(sample, structure)] = structures_3rd[structure]
-                else:
-                    print(f"⚠️ {sample} 中未找到结构 {structure}")
-            else:
-                print(f"⚠️ 未找到样本 {sample}")
+        members = grouped_structures[group_id]
+        structure_details = {key: flat_third[key] for key in members if key in flat_third}
+        if len(structure_details) < len(members):
+            missing = [key for key in members if key not in flat_third]
+            print(f"⚠️ Group {group_id} 中有 {len(missing)} 个结构未找到: {missing}")
 
         if not structure_details:
             print(f"⚠️ Group {group_id} 没有有效的结构，跳过")
             continue
 
-        try:
-            result = iterative_structure_analysis(structure_details, adata, row, coverage_threshold=coverage_threshold, sample_key=sample_key, row_key=row_key,
-                                                  col_key=col_key, leiden_key=leiden_key,focus_group = focus_group, group_key=group_key,
-                                                  fc_threshold= fc_threshold,p_threshold= p_threshold)
-            result_dict[idx] = result
-        except Exception as e:
-            print(f"❌ Group {group_id} 出错: {e}")
+        if n_jobs == 1:
+            # run in place so each group's log follows its index
+            result = _run_group_analysis(group_id, structure_details, adata, row, **analysis_kwargs)
+            if result is not None:
+                result_dict[idx] = result
+        else:
+            jobs.append((idx, group_id, structure_details, row))
+
+    if jobs:
+        # workers only read the sample/group columns once the spot tables are
+        # built, so ship an obs-only AnnData instead of pickling the full matrix
+        adata_slim = sc.AnnData(obs=adata.obs[[sample_key, group_key]].copy())
+        results = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(_run_group_analysis)(group_id, structure_details, adata_slim, row, **analysis_kwargs)
+            for _, group_id, structure_details, row in jobs
+        )
+        for (idx, _, _, _), result in zip(jobs, results):
+            if result is not None:
+                result_dict[idx] = result
 
     return result_dict
 
@@ -1153,43 +1315,40 @@ def plot_structure_hex(
     vert_dist = 3/4 * height
     horiz_dist = width
 
-    coords = [pt[0] for pt in structure]
+    coords = np.array([pt[0] for pt in structure], dtype=float).reshape(-1, 2)
     labels = [int(pt[1]) for pt in structure]
 
-    new_coords = []
-    for q, r in coords:
-        x = q * horiz_dist
-        y = r * vert_dist
-        new_coords.append((x, y))
+    new_coords = coords * [horiz_dist, vert_dist]
 
 
     fig, ax = plt.subplots(figsize=(6, 6))
 
 
-    for i, (x1, y1) in enumerate(new_coords):
-        for j, (x2, y2) in enumerate(new_coords):
-            if i < j:
-
-                dq = abs(coords[i][0] - coords[j][0])
-                dr = abs(coords[i][1] - coords[j][1])
-                if (dq, dr) in [(1, 0), (0, 2), (1, 1)]:
-                    ax.plot([x1, x2], [y1, y2], color='gray', linewidth=1.2, zorder=1)
+    # hexagonal neighbors differ by (1, 0), (0, 2) or (1, 1) in |row|, |col|
+    i, j = np.triu_indices(len(coords), 1)
+    dq, dr = np.abs(coords[i] - coords[j]).T
+    adjacent = ((dq == 1) & ((dr == 0) | (dr == 1))) | ((dq == 0) & (dr == 2))
+    edges = np.stack([new_coords[i[adjacent]], new_coords[j[adjacent]]], axis=1)
+    ax.add_collection(LineCollection(edges, colors='gray', linewidths=1.2, zorder=1))
 
 
-    for (x, y), label in zip(new_coords, labels):
-        hexagon = RegularPolygon(
+    hexagons = [
+        RegularPolygon(
             (x, y), numVertices=6, radius=hex_size,
             orientation=np.radians(30), facecolor=plt.cm.tab10(label % 10),
-            edgecolor='white', linewidth=1.2, zorder=2
+            edgecolor='white', linewidth=1.2
         )
-        ax.add_patch(hexagon)
+        for (x, y), label in zip(new_coords, labels)
+    ]
+    ax.add_collection(PatchCollection(hexagons, match_original=True, zorder=2))
+    for (x, y), label in zip(new_coords, labels):
         ax.text(x, y, str(label), ha='center', va='center', color='white', fontsize=12, weight='bold', zorder=3)
 
 
-    xs, ys = zip(*new_coords)
+    xs, ys = new_coords[:, 0], new_coords[:, 1]
     padding = 2 * hex_size
-    ax.set_xlim(min(xs) - padding, max(xs) + padding)
-    ax.set_ylim(min(ys) - padding, max(ys) + padding)
+    ax.set_xlim(xs.min() - padding, xs.max() + padding)
+    ax.set_ylim(ys.min() - padding, ys.max() + padding)
 
     ax.set_aspect('equal')
     ax.axis('off')
@@ -1277,18 +1436,21 @@ def highlight_niche_on_spatial(
     adata_sample = sc.read_visium(sample_path)
 
   
-    niche_all_coords = set()
-    for structure, coord_list in sample_structures.items():
-        niche_all_coords.update((int(x), int(y)) for (x, y), _ in coord_list)
+    niche_hashes = np.fromiter(
+        (int(x) * _COORD_HASH_BASE + int(y)
+         for coord_list in sample_structures.values() for (x, y), _ in coord_list),
+        dtype=np.int64
+    )
 
   
-    adata_sample.obs['niche_status'] = adata_sample.obs.apply(
-        lambda row: 'niche' if (row['array_row'], row['array_col']) in niche_all_coords else 'background',
-        axis=1
+    spot_hashes = (
+        adata_sample.obs['array_row'].to_numpy(dtype=np.int64) * _COORD_HASH_BASE
+        + adata_sample.obs['array_col'].to_numpy(dtype=np.int64)
+    )
+    adata_sample.obs['niche_status'] = pd.Categorical(
+        np.where(np.isin(spot_hashes, niche_hashes), 'niche', 'background'),
+        categories=['background', 'niche']
     )
-    adata_sample.obs['niche_status'] = adata_sample.obs['niche_status'].astype('category')
-    
-    adata_sample.obs['niche_status'] = adata_sample.obs['niche_status'].cat.set_categories(['background', 'niche'])
 
 
     color_palette = [background_color, niche_color]
@@ -1312,6 +1474,41 @@ def highlight_niche_on_spatial(
         save=save_arg
     )
 
+def _collect_niche_mask(adata, selected_result, spot_index=None):
+    """
+    Boolean masks over `adata.obs` for the spots of the samples in
+    `selected_result` and for the spots covered by its niche structures.
+    """
+    if spot_index is None:
+        spot_index = build_spot_index(adata)
+    nich_index = {
+        name
+        for (sample, _), nodes in selected_result.items()
+        for (r, c), _ in nodes
+        for name in spot_index.get((sample, r, c), ())
+    }
+
+    samples = {sample for sample, _ in selected_result.keys()}
+    sample_mask = adata.obs['sample_id'].isin(samples).to_numpy()
+    in_niche_mask = np.zeros(adata.n_obs, dtype=bool)
+    in_niche_mask[adata.obs.index.get_indexer_for(list(nich_index))] = True
+    return sample_mask, in_niche_mask
+
+
+@contextmanager
+def _temporary_obs_column(adata, key, values):
+    """Set ``adata.obs[key]`` for the duration of the block, then restore it."""
+    previous = adata.obs[key] if key in adata.obs.columns else None
+    adata.obs[key] = values
+    try:
+        yield adata
+    finally:
+        if previous is None:
+            del adata.obs[key]
+        else:
+            adata.obs[key] = previous
+
+
 def run_niche_differential_and_enrichment(
     adata,
     all_iterative_results,
@@ -1322,7 +1519,8 @@ def run_niche_differential_and_enrichment(
     organism='Human',
     top_n=20,
     output_prefix=None,
-    show_plot=True
+    show_plot=True,
+    spot_index=None
 ):
     """
     Perform differential gene expression and functional enrichment analysis for a specific niche group.
@@ -1365,6 +1563,10 @@ def run_niche_differential_and_enrichment(
     show_plot : bool, default=True
         Whether to display enrichment and volcano plots interactively.
 
+    spot_index : dict or None, optional
+        ``(sample, row, col) -> obs names`` map from `build_spot_index`. Pass the
+        same map when analyzing several groups to avoid rebuilding it per call.
+
     Returns
     -------
     None
@@ -1377,45 +1579,33 @@ def run_niche_differential_and_enrichment(
     """
 
 
-    nich_index = set()
     selected_result = all_iterative_results[group_index]
-    
-    for (sample, _), nodes in selected_result.items():
-        for (r, c), _ in nodes:
-            hits = adata.obs.reset_index().query(
-                "sample_id == @sample and array_row == @r and array_col == @c"
-            )['index'].tolist()
-            nich_index.update(hits)
 
+    sample_mask, in_niche_mask = _collect_niche_mask(adata, selected_result, spot_index)
 
-    samples = {sample for sample, _ in selected_result.keys()}
 
-
-    obs = adata.obs.copy()
-    obs['in_nich'] = False
-    obs.loc[list(nich_index), 'in_nich'] = True
-    mask = obs['sample_id'].isin(samples)
-    adata_subset = adata[mask].copy()
-    adata_subset.obs['in_nich'] = obs.loc[mask, 'in_nich']
-
-
-    adata_subset.obs['niche_label'] = adata_subset.obs['in_nich'].map({
-        True: 'niche', False: 'background'
-    }).astype('category')
-    adata_subset.obs['niche_label'] = adata_subset.obs['niche_label'].cat.reorder_categories(
-        ['niche', 'background']
+    # spots outside the selected samples get no label, so the test only
+    # compares niche vs background and adata never has to be subset/copied
+    niche_label = pd.Categorical.from_codes(
+        np.where(sample_mask, np.where(in_niche_mask, 0, 1), -1),
+        categories=['niche', 'background']
     )
 
 
-    sc.tl.rank_genes_groups(
-        adata_subset,
-        groupby='niche_label',
-        groups=['niche'],
-        reference='background',
-        method='wilcoxon'
-    )
-
-    df_de = sc.get.rank_genes_groups_df(adata_subset, group='niche')
+    de_key = '_stniche_niche_de'
+    with _temporary_obs_column(adata, 'niche_label', niche_label):
+        try:
+            sc.tl.rank_genes_groups(
+                adata,
+                groupby='niche_label',
+                groups=['niche'],
+                reference='background',
+                method='wilcoxon',
+                key_added=de_key
+            )
+            df_de = sc.get.rank_genes_groups_df(adata, group='niche', key=de_key)
+        finally:
+            adata.uns.pop(de_key, None)
 
     
  
@@ -1450,9 +1640,9 @@ def run_niche_differential_and_enrichment(
     
     
 
-    kegg_res = enr.results.sort_values('Adjusted P-value').head(top_n).copy()
-    kegg_res['Shortened Term'] = kegg_res['Term'].apply(lambda x: re.sub(r"\s*\(.*?\)", "", x))
-    kegg_res['-log10(Adjusted P-value)'] = -np.log10(kegg_res['Adjusted P-value'])
+    kegg_res = enrichment_df.nsmallest(top_n, 'Adjusted P-value').copy()
+    kegg_res['Shortened Term'] = kegg_res['Term'].str.replace(_PAREN_RE, "", regex=True)
+    kegg_res['-log10(Adjusted P-value)'] = -np.log10(kegg_res['Adjusted P-value'].to_numpy())
 
     plt.figure(figsize=(12, 8))
     sns.barplot(x='-log10(Adjusted P-value)', y='Shortened Term', data=kegg_res, palette='viridis')
@@ -1482,7 +1672,8 @@ def plot_spatial_communication_sankey(
     direction='niche',  # or 'non_niche'
     top_n=50,
     output_dir=None,
-    show_plot=True
+    show_plot=True,
+    spot_index=None
 ):
     """
     Visualize spatial communication pathways as a Sankey diagram.
@@ -1517,6 +1708,10 @@ def plot_spatial_communication_sankey(
     show_plot : bool, default=True
         Whether to display the Sankey plot interactively.
 
+    spot_index : dict or None, optional
+        ``(sample, row, col) -> obs names`` map from `build_spot_index`. Built
+        from `adata` when not given.
+
     Returns
     -------
     None
@@ -1529,24 +1724,14 @@ def plot_spatial_communication_sankey(
 
 
     selected_result = all_iterative_results[group_index]
-    nich_index = set()
-    for (sample, _), nodes in selected_result.items():
-        for (r, c), _ in nodes:
-            hits = adata.obs.reset_index().query(
-                "sample_id == @sample and array_row == @r and array_col == @c"
-            )['index'].tolist()
-            nich_index.update(hits)
-
 
-    samples = {sample for sample, _ in selected_result.keys()}
-    obs = adata.obs.copy()
-    obs['in_nich'] = False
-    obs.loc[list(nich_index), 'in_nich'] = True
-    mask = obs['sample_id'].isin(samples)
-    adata_combined_all = adata[mask].copy()
-    adata_combined_all.obs['in_nich'] = obs.loc[mask, 'in_nich']
+    sample_mask, in_niche_mask = _collect_niche_mask(adata, selected_result, spot_index)
+    adata_combined_all = adata[sample_mask].copy()
+    adata_combined_all.obs['in_nich'] = in_niche_mask[sample_mask]
     adata_combined_all.obsm['spatial'] = adata_combined_all.obs[['array_row', 'array_col']].to_numpy(dtype=float)
-    adata_combined_all.obs['niche_group'] = adata_combined_all.obs['in_nich'].map(lambda x: 'niche' if x else 'non_niche').astype('category')
+    adata_combined_all.obs['niche_group'] = pd.Categorical(
+        np.where(in_niche_mask[sample_mask], 'niche', 'non_niche')
+    )
 
 
     sq.gr.spatial_neighbors(adata_combined_all, coord_type="grid")
@@ -1569,7 +1754,7 @@ def plot_spatial_communication_sankey(
         raise ValueError("❌ direction 参数必须是 'niche' 或 'non_niche'")
 
 
-    top_pairs = comm_scores.sort_values(ascending=False).head(top_n)
+    top_pairs = comm_scores.nlargest(top_n)
     top_df = top_pairs.reset_index()
     top_df.columns = ['Ligand', 'Receptor', 'Score']
 
@@ -1580,9 +1765,11 @@ def plot_spatial_communication_sankey(
 
     nodes = [{"name": name} for name in set(ligands) | set(receptors)]
     all_nodes = [node['name'] for node in nodes]
+    node_ix = {name: i for i, name in enumerate(all_nodes)}
+    ligand_set = set(ligands)
     links = [{
-        "source": all_nodes.index(lig),
-        "target": all_nodes.index(rec),
+        "source": node_ix[lig],
+        "target": node_ix[rec],
         "value": round(score, 4)
     } for lig, rec, score in zip(ligands, receptors, scores)]
 
@@ -1595,7 +1782,7 @@ def plot_spatial_communication_sankey(
             thickness=20,
             line=dict(color="black", width=0.5),
             label=all_nodes,
-            color=["#FF6666" if n in ligands else "#66B2FF" for n in all_nodes]
+            color=["#FF6666" if n in ligand_set else "#66B2FF" for n in all_nodes]
         ),
         link=dict(
             source=[link['source'] for link in links],